@@ -4,11 +4,15 @@ import asyncio
 import aiohttp
 import json
 import os
+import sys
 from datetime import datetime
 import hashlib
 import hmac
+import base64
+import binascii
 from aiohttp import web
 import logging
+import orjson
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -21,156 +25,299 @@ TRELLO_TOKEN = os.environ.get('TRELLO_TOKEN')
 TRELLO_WEBHOOK_SECRET = os.environ.get('TRELLO_WEBHOOK_SECRET')
 DISCORD_CHANNEL_ID = int(os.environ.get('DISCORD_CHANNEL_ID', 0))
 WEBHOOK_URL = os.environ.get('WEBHOOK_URL')  # Your public webhook URL
+DISCORD_INCOMING_WEBHOOK_URL = os.environ.get('DISCORD_INCOMING_WEBHOOK_URL')  # Optional Discord webhook for notifications
 PORT = int(os.environ.get('PORT', 8080))
+MAX_QUEUED_EVENTS = int(os.environ.get('MAX_QUEUED_EVENTS', 1000))  # Webhooks get 503 beyond this
+DISPATCH_WORKERS = int(os.environ.get('DISPATCH_WORKERS', 1))  # Tasks sending queued events to Discord
+
+# Trello signs webhooks with HMAC-SHA1 only, so SHA-256 is not an option here.
+# hashlib.sha1 is backed by OpenSSL, which already uses its optimized assembly.
+_WEBHOOK_DIGEST = hashlib.sha1
+
+# Trello signs the request body followed by the callback URL the webhook was registered with
+WEBHOOK_CALLBACK_URL = f"{WEBHOOK_URL}/webhook"
+_CALLBACK_URL_BYTES = WEBHOOK_CALLBACK_URL.encode()
+
+# HMAC keyed with the webhook secret; copied per request to skip key setup
+_SECRET_BYTES = TRELLO_WEBHOOK_SECRET.encode() if TRELLO_WEBHOOK_SECRET else None
+_MAC_PROTO = hmac.new(_SECRET_BYTES, b'', _WEBHOOK_DIGEST) if _SECRET_BYTES else None
+
+# datetime.fromisoformat accepts a trailing 'Z' from Python 3.11 on
+_FROMISOFORMAT_ACCEPTS_Z = sys.version_info >= (3, 11)
+
+# Trello action types that are forwarded to Discord
+INTERESTING_ACTIONS = frozenset({'createCard', 'updateCard', 'deleteCard', 'commentCard'})
+
+# Discord allows up to 10 embeds per message, 6000 characters across all of a
+# message's embeds, 4096 characters per description and 1024 per field value
+EMBED_DESCRIPTION_LIMIT = 4096
+EMBED_FIELD_LIMIT = 1024
+MAX_EMBEDS_PER_MESSAGE = 10
+MAX_EMBED_CHARS_PER_MESSAGE = 6000
+BATCH_FLUSH_SECONDS = 0.5
 
 # Bot setup
 intents = discord.Intents.default()
 intents.message_content = True
 bot = commands.Bot(command_prefix='!', intents=intents)
+bot.http_session = None  # Session for the Discord incoming webhook, created in main() if configured
+bot.trello_session = None  # Keep-alive session for the Trello API, created in main()
+
+def truncate_field(text, limit=EMBED_FIELD_LIMIT):
+    """Trim text to fit in a Discord embed field value (or another embed limit)"""
+    if len(text) <= limit:
+        return text
+    return text[:limit - 1] + "…"
 
 class TrelloWebhookHandler:
+    __slots__ = ('bot', 'app', 'drain_tasks', '_queue', '_channel', '_webhook')
+    
     def __init__(self, bot):
         self.bot = bot
+        self._queue = None  # Created in start_workers, once the event loop is running
+        self._channel = None  # Resolved lazily from DISCORD_CHANNEL_ID
+        self._webhook = None  # Set in on_ready when DISCORD_INCOMING_WEBHOOK_URL is configured
+        self.drain_tasks = []
         self.app = web.Application()
         self.app.router.add_post('/webhook', self.handle_webhook)
         self.app.router.add_get('/health', self.health_check)
         
+    def start_workers(self, count):
+        """Create the event queue and start the dispatch workers on the running loop"""
+        self._queue = asyncio.Queue(maxsize=MAX_QUEUED_EVENTS)
+        self.drain_tasks = [asyncio.create_task(self._drain()) for _ in range(count)]
+    
+    def set_webhook(self, webhook):
+        """Send notifications through a Discord incoming webhook instead of the channel"""
+        self._webhook = webhook
+    
+    def invalidate_channel(self):
+        """Forget the cached channel so it is resolved again on the next send"""
+        self._channel = None
+    
     async def health_check(self, request):
         return web.Response(text="Bot is running!")
     
     async def handle_webhook(self, request):
         try:
+            # Read the body once for both signature check and parsing
+            body = await request.read()
+            
             # Verify webhook signature
-            if not await self.verify_webhook_signature(request):
+            if not self._verify_sig(request.headers.get('X-Trello-Webhook'), body):
                 return web.Response(status=401, text="Unauthorized")
             
             # Parse webhook data
-            data = await request.json()
-            await self.process_trello_event(data)
+            data = orjson.loads(body)
+            
+            # Ignore action types we don't forward before doing any more work
+            action_type = (data.get('action') or {}).get('type')
+            if action_type not in INTERESTING_ACTIONS:
+                return web.Response(text="OK")
+            
+            # Hand off to the dispatch workers and acknowledge Trello right away;
+            # shed load explicitly when the queue is full
+            try:
+                self._queue.put_nowait(data['action'])
+            except asyncio.QueueFull:
+                logger.warning("Event queue is full, rejecting webhook")
+                return web.Response(status=503, text="Service Unavailable")
             
             return web.Response(text="OK")
         except Exception as e:
             logger.error(f"Error handling webhook: {e}")
             return web.Response(status=500, text="Internal Server Error")
     
-    async def verify_webhook_signature(self, request):
-        if not TRELLO_WEBHOOK_SECRET:
+    def _verify_sig(self, signature, body):
+        if _MAC_PROTO is None:
             return True  # Skip verification if no secret is set
         
-        # Get the signature from headers
-        signature = request.headers.get('X-Trello-Webhook')
         if not signature:
             return False
         
-        # Get request body
-        body = await request.read()
+        # Trello sends the signature base64-encoded; compare raw digests
+        try:
+            provided_signature = base64.b64decode(signature, validate=True)
+        except (binascii.Error, ValueError):
+            return False
         
         # Calculate expected signature
-        expected_signature = hmac.new(
-            TRELLO_WEBHOOK_SECRET.encode(),
-            body,
-            hashlib.sha1
-        ).hexdigest()
+        mac = _MAC_PROTO.copy()
+        mac.update(body)
+        mac.update(_CALLBACK_URL_BYTES)
+        expected_signature = mac.digest()
         
-        return hmac.compare_digest(signature, expected_signature)
+        return hmac.compare_digest(provided_signature, expected_signature)
     
-    async def process_trello_event(self, data):
-        try:
-            action = data.get('action', {})
-            action_type = action.get('type')
+    async def _drain(self):
+        """Send queued actions to Discord as embeds, batching as many as one message allows"""
+        carry = None  # Embed that didn't fit in the previous batch
+        while True:
+            if carry is None:
+                carry = self._build_embed(await self._queue.get())
+                if carry is None:
+                    continue
             
-            # Process different types of Trello events
-            if action_type in ['createCard', 'updateCard', 'deleteCard', 'commentCard']:
-                await self.send_discord_message(action)
-        except Exception as e:
-            logger.error(f"Error processing Trello event: {e}")
+            batch = [carry]
+            size = len(carry)
+            carry = None
+            
+            # One flush deadline per batch, so no embed waits longer than BATCH_FLUSH_SECONDS
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + BATCH_FLUSH_SECONDS
+            while len(batch) < MAX_EMBEDS_PER_MESSAGE:
+                try:
+                    action = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        action = await asyncio.wait_for(self._queue.get(), timeout=remaining)
+                    except asyncio.TimeoutError:
+                        break
+                
+                embed = self._build_embed(action)
+                if embed is None:
+                    continue
+                
+                # Flush before the batch would exceed Discord's per-message character limit
+                if size + len(embed) > MAX_EMBED_CHARS_PER_MESSAGE:
+                    carry = embed
+                    break
+                batch.append(embed)
+                size += len(embed)
+            
+            try:
+                await self._send(batch)
+            except Exception as e:
+                if len(batch) == 1:
+                    logger.error(f"Error sending Discord message: {e}")
+                    continue
+                
+                # Don't lose the whole batch; retry the embeds one at a time
+                logger.warning(f"Error sending batch of {len(batch)} embeds, retrying individually: {e}")
+                for embed in batch:
+                    try:
+                        await self._send([embed])
+                    except Exception as e:
+                        logger.error(f"Error sending Discord message: {e}")
     
-    async def send_discord_message(self, action):
+    def _build_embed(self, action):
+        # Build embeds here rather than in the webhook handler
         try:
-            channel = self.bot.get_channel(DISCORD_CHANNEL_ID)
-            if not channel:
-                logger.error(f"Channel {DISCORD_CHANNEL_ID} not found")
-                return
-            
-            embed = self.create_embed(action)
-            await channel.send(embed=embed)
+            return self.create_embed(action)
         except Exception as e:
-            logger.error(f"Error sending Discord message: {e}")
+            logger.error(f"Error building embed: {e}")
+            return None
+    
+    async def _send(self, embeds):
+        # Prefer the incoming webhook, which has its own rate limit bucket
+        if self._webhook is not None:
+            await self._webhook.send(embeds=embeds)
+            return
+        
+        if self._channel is None:
+            # Events queued while the bot is still logging in wait for the gateway
+            await self.bot.wait_until_ready()
+            self._channel = self.bot.get_channel(DISCORD_CHANNEL_ID)
+        if not self._channel:
+            logger.error(f"Channel {DISCORD_CHANNEL_ID} not found")
+            return
+        
+        await self._channel.send(embeds=embeds)
     
     def create_embed(self, action):
         action_type = action.get('type')
-        member = action.get('memberCreator', {})
-        date = action.get('date', '')
+        member = action.get('memberCreator') or {}
+        date = action.get('date')
+        if not date:
+            ts = None
+        elif _FROMISOFORMAT_ACCEPTS_Z:
+            ts = datetime.fromisoformat(date)
+        else:
+            ts = datetime.fromisoformat(date.replace('Z', '+00:00'))
         
-        # Create embed based on action type
-        if action_type == 'createCard':
-            card = action.get('data', {}).get('card', {})
-            list_info = action.get('data', {}).get('list', {})
-            
-            embed = discord.Embed(
-                title="🆕 New Card Created",
-                description=f"**{card.get('name', 'Unknown')}**",
-                color=0x00ff00,
-                timestamp=datetime.fromisoformat(date.replace('Z', '+00:00'))
-            )
-            embed.add_field(name="List", value=list_info.get('name', 'Unknown'), inline=True)
-            embed.add_field(name="Creator", value=member.get('fullName', 'Unknown'), inline=True)
-            
-        elif action_type == 'updateCard':
-            card = action.get('data', {}).get('card', {})
-            old_data = action.get('data', {}).get('old', {})
-            
-            embed = discord.Embed(
-                title="📝 Card Updated",
-                description=f"**{card.get('name', 'Unknown')}**",
-                color=0xffaa00,
-                timestamp=datetime.fromisoformat(date.replace('Z', '+00:00'))
-            )
-            
-            # Check what was updated
-            if 'name' in old_data:
-                embed.add_field(name="Name Changed", value=f"From: {old_data['name']}\nTo: {card.get('name')}", inline=False)
-            if 'desc' in old_data:
-                embed.add_field(name="Description Updated", value="Description was modified", inline=False)
-            if 'pos' in old_data:
-                embed.add_field(name="Position Changed", value="Card was moved", inline=False)
-            
-            embed.add_field(name="Updated by", value=member.get('fullName', 'Unknown'), inline=True)
-            
-        elif action_type == 'deleteCard':
-            card = action.get('data', {}).get('card', {})
-            
-            embed = discord.Embed(
-                title="🗑️ Card Deleted",
-                description=f"**{card.get('name', 'Unknown')}**",
-                color=0xff0000,
-                timestamp=datetime.fromisoformat(date.replace('Z', '+00:00'))
-            )
-            embed.add_field(name="Deleted by", value=member.get('fullName', 'Unknown'), inline=True)
-            
-        elif action_type == 'commentCard':
-            card = action.get('data', {}).get('card', {})
-            text = action.get('data', {}).get('text', '')
-            
-            embed = discord.Embed(
-                title="💬 New Comment",
-                description=f"**{card.get('name', 'Unknown')}**",
-                color=0x0099ff,
-                timestamp=datetime.fromisoformat(date.replace('Z', '+00:00'))
-            )
-            embed.add_field(name="Comment", value=text[:1000] + "..." if len(text) > 1000 else text, inline=False)
-            embed.add_field(name="Comment by", value=member.get('fullName', 'Unknown'), inline=True)
+        data = action.get('data') or {}
+        card = data.get('card') or {}
         
-        else:
-            embed = discord.Embed(
-                title="🔄 Trello Update",
-                description=f"Action: {action_type}",
-                color=0x666666,
-                timestamp=datetime.fromisoformat(date.replace('Z', '+00:00'))
-            )
-            embed.add_field(name="User", value=member.get('fullName', 'Unknown'), inline=True)
+        builder = self._BUILDERS.get(action_type, TrelloWebhookHandler._build_default)
+        return builder(self, action, data, card, member, ts)
+    
+    def _build_create(self, action, data, card, member, ts):
+        list_info = data.get('list') or {}
+        
+        embed = discord.Embed(
+            title="🆕 New Card Created",
+            description=f"**{truncate_field(card.get('name', 'Unknown'), EMBED_DESCRIPTION_LIMIT - 4)}**",
+            color=0x00ff00,
+            timestamp=ts
+        )
+        embed.add_field(name="List", value=list_info.get('name', 'Unknown'), inline=True)
+        embed.add_field(name="Creator", value=member.get('fullName', 'Unknown'), inline=True)
+        return embed
+    
+    def _build_update(self, action, data, card, member, ts):
+        old_data = data.get('old') or {}
+        
+        embed = discord.Embed(
+            title="📝 Card Updated",
+            description=f"**{truncate_field(card.get('name', 'Unknown'), EMBED_DESCRIPTION_LIMIT - 4)}**",
+            color=0xffaa00,
+            timestamp=ts
+        )
+        
+        # Check what was updated
+        if 'name' in old_data:
+            embed.add_field(name="Name Changed", value=truncate_field(f"From: {old_data['name']}\nTo: {card.get('name')}"), inline=False)
+        if 'desc' in old_data:
+            embed.add_field(name="Description Updated", value="Description was modified", inline=False)
+        if 'pos' in old_data:
+            embed.add_field(name="Position Changed", value="Card was moved", inline=False)
         
+        embed.add_field(name="Updated by", value=member.get('fullName', 'Unknown'), inline=True)
         return embed
+    
+    def _build_delete(self, action, data, card, member, ts):
+        embed = discord.Embed(
+            title="🗑️ Card Deleted",
+            description=f"**{truncate_field(card.get('name', 'Unknown'), EMBED_DESCRIPTION_LIMIT - 4)}**",
+            color=0xff0000,
+            timestamp=ts
+        )
+        embed.add_field(name="Deleted by", value=member.get('fullName', 'Unknown'), inline=True)
+        return embed
+    
+    def _build_comment(self, action, data, card, member, ts):
+        text = data.get('text') or ''
+        
+        embed = discord.Embed(
+            title="💬 New Comment",
+            description=f"**{truncate_field(card.get('name', 'Unknown'), EMBED_DESCRIPTION_LIMIT - 4)}**",
+            color=0x0099ff,
+            timestamp=ts
+        )
+        embed.add_field(name="Comment", value=truncate_field(text), inline=False)
+        embed.add_field(name="Comment by", value=member.get('fullName', 'Unknown'), inline=True)
+        return embed
+    
+    def _build_default(self, action, data, card, member, ts):
+        embed = discord.Embed(
+            title="🔄 Trello Update",
+            description=f"Action: {action.get('type')}",
+            color=0x666666,
+            timestamp=ts
+        )
+        embed.add_field(name="User", value=member.get('fullName', 'Unknown'), inline=True)
+        return embed
+    
+    # Embed builder per Trello action type
+    _BUILDERS = {
+        'createCard': _build_create,
+        'updateCard': _build_update,
+        'deleteCard': _build_delete,
+        'commentCard': _build_comment,
+    }
 
 # Initialize webhook handler
 webhook_handler = TrelloWebhookHandler(bot)
@@ -180,26 +327,31 @@ async def on_ready():
     logger.info(f'{bot.user} has connected to Discord!')
     logger.info(f'Bot is in {len(bot.guilds)} guilds')
 
+@bot.event
+async def on_guild_channel_delete(channel):
+    # Drop the cached notification channel so it is resolved again
+    if channel.id == DISCORD_CHANNEL_ID:
+        webhook_handler.invalidate_channel()
+
 @bot.command(name='setup_webhook')
 @commands.has_permissions(administrator=True)
 async def setup_webhook(ctx, board_id: str):
     """Setup Trello webhook for a specific board"""
     try:
-        async with aiohttp.ClientSession() as session:
-            webhook_data = {
-                'key': TRELLO_API_KEY,
-                'token': TRELLO_TOKEN,
-                'callbackURL': f"{WEBHOOK_URL}/webhook",
-                'idModel': board_id,
-                'description': 'Discord Bot Webhook'
-            }
-            
-            async with session.post('https://api.trello.com/1/webhooks', data=webhook_data) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    await ctx.send(f"✅ Webhook created successfully! ID: {result['id']}")
-                else:
-                    await ctx.send(f"❌ Failed to create webhook. Status: {response.status}")
+        webhook_data = {
+            'key': TRELLO_API_KEY,
+            'token': TRELLO_TOKEN,
+            'callbackURL': WEBHOOK_CALLBACK_URL,
+            'idModel': board_id,
+            'description': 'Discord Bot Webhook'
+        }
+        
+        async with bot.trello_session.post('https://api.trello.com/1/webhooks', data=webhook_data) as response:
+            if response.status == 200:
+                result = await response.json()
+                await ctx.send(f"✅ Webhook created successfully! ID: {result['id']}")
+            else:
+                await ctx.send(f"❌ Failed to create webhook. Status: {response.status}")
     except Exception as e:
         await ctx.send(f"❌ Error: {str(e)}")
 
@@ -208,20 +360,19 @@ async def setup_webhook(ctx, board_id: str):
 async def list_webhooks(ctx):
     """List all active webhooks"""
     try:
-        async with aiohttp.ClientSession() as session:
-            url = f"https://api.trello.com/1/tokens/{TRELLO_TOKEN}/webhooks"
-            params = {'key': TRELLO_API_KEY}
-            
-            async with session.get(url, params=params) as response:
-                if response.status == 200:
-                    webhooks = await response.json()
-                    if webhooks:
-                        webhook_list = "\n".join([f"ID: {w['id']}, Board: {w['idModel']}" for w in webhooks])
-                        await ctx.send(f"📋 Active webhooks:\n```{webhook_list}```")
-                    else:
-                        await ctx.send("📋 No webhooks found.")
+        url = f"https://api.trello.com/1/tokens/{TRELLO_TOKEN}/webhooks"
+        params = {'key': TRELLO_API_KEY}
+        
+        async with bot.trello_session.get(url, params=params) as response:
+            if response.status == 200:
+                webhooks = await response.json()
+                if webhooks:
+                    webhook_list = "\n".join([f"ID: {w['id']}, Board: {w['idModel']}" for w in webhooks])
+                    await ctx.send(f"📋 Active webhooks:\n```{webhook_list}```")
                 else:
-                    await ctx.send(f"❌ Failed to fetch webhooks. Status: {response.status}")
+                    await ctx.send("📋 No webhooks found.")
+            else:
+                await ctx.send(f"❌ Failed to fetch webhooks. Status: {response.status}")
     except Exception as e:
         await ctx.send(f"❌ Error: {str(e)}")
 
@@ -230,15 +381,14 @@ async def list_webhooks(ctx):
 async def delete_webhook(ctx, webhook_id: str):
     """Delete a specific webhook"""
     try:
-        async with aiohttp.ClientSession() as session:
-            url = f"https://api.trello.com/1/webhooks/{webhook_id}"
-            params = {'key': TRELLO_API_KEY, 'token': TRELLO_TOKEN}
-            
-            async with session.delete(url, params=params) as response:
-                if response.status == 200:
-                    await ctx.send(f"✅ Webhook {webhook_id} deleted successfully!")
-                else:
-                    await ctx.send(f"❌ Failed to delete webhook. Status: {response.status}")
+        url = f"https://api.trello.com/1/webhooks/{webhook_id}"
+        params = {'key': TRELLO_API_KEY, 'token': TRELLO_TOKEN}
+        
+        async with bot.trello_session.delete(url, params=params) as response:
+            if response.status == 200:
+                await ctx.send(f"✅ Webhook {webhook_id} deleted successfully!")
+            else:
+                await ctx.send(f"❌ Failed to delete webhook. Status: {response.status}")
     except Exception as e:
         await ctx.send(f"❌ Error: {str(e)}")
 
@@ -257,6 +407,9 @@ async def test_channel(ctx):
 
 async def start_webhook_server():
     """Start the webhook server"""
+    # Workers (and their queue) must exist before the first webhook arrives
+    webhook_handler.start_workers(DISPATCH_WORKERS)
+    
     runner = web.AppRunner(webhook_handler.app)
     await runner.setup()
     site = web.TCPSite(runner, '0.0.0.0', PORT)
@@ -265,15 +418,46 @@ async def start_webhook_server():
 
 async def main():
     """Main function to run both bot and webhook server"""
-    # Start webhook server
-    await start_webhook_server()
+    # Keep api.trello.com connections alive so admin commands skip the TLS handshake.
+    # Created up front since commands can run before on_ready fires.
+    bot.trello_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=20, limit_per_host=20, ttl_dns_cache=600, keepalive_timeout=75
+        ),
+        timeout=aiohttp.ClientTimeout(total=10)
+    )
+    
+    # The incoming webhook doesn't need the gateway, so set it up before the
+    # dispatch workers start rather than waiting for on_ready
+    if DISCORD_INCOMING_WEBHOOK_URL:
+        bot.http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=20, ttl_dns_cache=300)
+        )
+        webhook_handler.set_webhook(discord.Webhook.from_url(
+            DISCORD_INCOMING_WEBHOOK_URL, session=bot.http_session
+        ))
     
-    # Start Discord bot
-    await bot.start(TOKEN)
+    try:
+        # Start webhook server
+        await start_webhook_server()
+        
+        # Start Discord bot
+        await bot.start(TOKEN)
+    finally:
+        for session in (bot.trello_session, bot.http_session):
+            if session is not None:
+                await session.close()
 
 if __name__ == "__main__":
+    # Use uvloop's faster event loop where available (Linux/macOS)
+    try:
+        import uvloop
+        run = uvloop.run
+    except ImportError:
+        run = asyncio.run
+    
     try:
-        asyncio.run(main())
+        run(main())
     except KeyboardInterrupt:
         logger.info("Bot stopped by user")
     except Exception as e: